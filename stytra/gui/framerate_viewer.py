@@ -1,12 +1,42 @@
-from PyQt5.QtCore import QPoint
+from PyQt5.QtCore import QPoint, QRect, QTimer, QEvent, QLineF
 from PyQt5.QtWidgets import QWidget, QLabel, QHBoxLayout, QSizePolicy, QSpacerItem
-from PyQt5.QtGui import QPainter, QColor, QPen, QBrush
+from PyQt5.QtGui import QPainter, QColor, QPen, QBrush, QPixmap
 from PyQt5.QtCore import Qt
 
-import numpy as np
+import math
+import time
+
+
+def framerate_limits(fps_min, fps_max, goal_framerate):
+    """Returns the lower and upper framerate to be displayed, spanning the
+    recent framerate range and the goal framerate, if either is present.
+    Otherwise returns None.
+    """
+    if fps_min is None:
+        if goal_framerate is None:
+            return None
+        return goal_framerate, goal_framerate
+    if goal_framerate is None:
+        return fps_min, fps_max
+    return min(fps_min, goal_framerate), max(fps_max, goal_framerate)
 
 
 class FramerateWidget(QWidget):
+    """Displays the current framerate of an accumulator against its goal,
+    with a shadow spanning the recent framerate range.
+
+    Parameters
+    ----------
+    acc : FramerateAccumulator
+        accumulator holding the framerates
+    inertia : float
+        fraction of the shadow extent kept after 1/60 s, the decay is
+        scaled by the time elapsed between updates
+
+    """
+
+    inertia_interval = 1 / 60
+
     def __init__(self, acc, inertia=0.985):
         super().__init__()
         self.acc = acc
@@ -21,10 +51,48 @@ class FramerateWidget(QWidget):
         self.indicator_shadow_color = (17, 147, 91)
         self.error_indicator_color = (230, 40, 0)
         self.error_indicator_shadow_color = (170, 30, 0)
+        self.limit_color = (200, 200, 200)
+        self.goal_color = (80, 80, 80)
+        self.pad = 6
+        self.text_height = 16
+
+        # the static part of the widget is cached in a pixmap, which is
+        # redrawn only if the size or the bounds change
+        self._bg_pixmap = None
+        self._bg_key = None
+        self._last_dynamic_rects = None
+        self._last_data = None
+        self._last_update_time = None
+        self._text_widths = dict()
+        self._bounds_key = None
+        self._last_bounds = None
+
+    def needs_update(self):
+        """Whether a new framerate arrived or the shadow is still moving"""
+        if len(self.acc.stored_data) > 0:
+            last_data = (len(self.acc.stored_data), self.acc.stored_data[-1])
+        else:
+            last_data = None
+        return last_data != self._last_data or (
+            self.fps_inertia_max is not None
+            and self.fps_inertia_max - self.fps_inertia_min > 1e-3 * abs(self.fps)
+        )
 
     def update(self):
+        # the inertia is given per inertia_interval, and applied
+        # according to the time passed since the last update
+        current_time = time.monotonic()
+        if self._last_update_time is None:
+            inertia = self.inertia
+        else:
+            inertia = self.inertia ** (
+                (current_time - self._last_update_time) / self.inertia_interval
+            )
+        self._last_update_time = current_time
+
         self.set_fps = False
         if len(self.acc.stored_data) > 0:
+            self._last_data = (len(self.acc.stored_data), self.acc.stored_data[-1])
             self.fps = self.acc.stored_data[-1]
             self.set_fps = self.fps is not None
             if self.fps_inertia_max is None:
@@ -35,55 +103,189 @@ class FramerateWidget(QWidget):
                     self.fps_inertia_max = self.fps
                 else:
                     self.fps_inertia_max = (
-                        self.fps_inertia_max * self.inertia
-                        + self.fps * (1 - self.inertia)
+                        self.fps_inertia_max * inertia + self.fps * (1 - inertia)
                     )
 
                 if self.fps < self.fps_inertia_min:
                     self.fps_inertia_min = self.fps
                 else:
                     self.fps_inertia_min = (
-                        self.fps_inertia_min * self.inertia
-                        + self.fps * (1 - self.inertia)
+                        self.fps_inertia_min * inertia + self.fps * (1 - inertia)
                     )
 
-        super().update()
+        self._request_repaint()
 
-    def paintEvent(self, e):
+    def _request_repaint(self):
+        """Invalidates only the regions occupied by the moving indicator
+        (before and after the update) if the static background is still
+        valid, otherwise the whole widget
+        """
+        bounds = self._bounds()
+        size = self.size()
+        w = size.width()
+        h = size.height()
+        if (
+            bounds is None
+            or self._last_dynamic_rects is None
+            or self._bg_key != self._background_key(w, h, *bounds)
+        ):
+            super().update()
+            return
+
+        for rect in self._last_dynamic_rects + self._dynamic_rects(w, h, *bounds):
+            super().update(rect)
+
+    def _bounds(self):
+        """Returns the rounded lower and upper value of the displayed
+        framerate range, or None if there is nothing to display.
+        The result is reused until the framerates it depends on change.
+        """
+        bounds_key = (
+            self.fps is None,
+            self.fps_inertia_min,
+            self.fps_inertia_max,
+            self.g_fps,
+        )
+        if bounds_key != self._bounds_key:
+            self._bounds_key = bounds_key
+            self._last_bounds = self._compute_bounds()
+        return self._last_bounds
+
+    def _compute_bounds(self):
         # Three valid cases: there are both a goal and current framerate
         # or either of them
-        if self.fps is not None:
-            if self.g_fps is not None:
-                lb = min(self.fps_inertia_min, self.g_fps)
-                ub = max(self.fps_inertia_max, self.g_fps)
-            else:
-                lb = self.fps_inertia_min
-                ub = self.fps_inertia_max
-        else:
-            if self.g_fps is not None:
-                lb = self.g_fps
-                ub = self.g_fps
-            else:
-                return
+        limits = framerate_limits(
+            self.fps_inertia_min if self.fps is not None else None,
+            self.fps_inertia_max,
+            self.g_fps,
+        )
+        if limits is None:
+            return None
+        lb, ub = limits
+
+        min_bound = math.floor(lb * 0.08) * 10
+        max_bound = math.ceil(ub * 0.12) * 10
+        if max_bound == min_bound:
+            max_bound += 1
+        return min_bound, max_bound
+
+    def _dynamic_rects(self, w, h, min_bound, max_bound):
+        """Rectangles covering the parts of the widget which change with the
+        current framerate: the indicator with its shadow and the label
+        """
+        if not (self.set_fps and self.fps is not None):
+            return []
+        w_min, w_max, h_min, h_max = self._geometry(w, h)
+        delta_w = w_max - w_min
+        delta_bound = max_bound - min_bound
+
+        x_coords = [
+            int(w_min + (fps - min_bound) * delta_w / delta_bound)
+            for fps in (self.fps, self.fps_inertia_min, self.fps_inertia_max)
+        ]
+        x_left = min(x_coords)
+        x_right = max(x_coords)
+        textw = self._text_width("{:.1f}".format(self.fps))
+        return [
+            QRect(x_left - 2, h_min, x_right - x_left + 4, h - h_min),
+            QRect((w_max + w_min - textw) // 2 - 2, 0, textw + 4, h_min),
+        ]
+
+    def _text_width(self, text):
+        """Width of a label in the widget font, cached as the labels are
+        few and repeat often
+        """
+        try:
+            return self._text_widths[text]
+        except KeyError:
+            width = self.fontMetrics().width(text)
+            if len(self._text_widths) > 1000:
+                self._text_widths = dict()
+            self._text_widths[text] = width
+            return width
+
+    def changeEvent(self, e):
+        if e.type() == QEvent.FontChange:
+            self._text_widths = dict()
+            self._bg_key = None
+            self._last_dynamic_rects = None
+        super().changeEvent(e)
+
+    def resizeEvent(self, e):
+        self._bg_key = None
+        self._last_dynamic_rects = None
+        super().resizeEvent(e)
+
+    def _render_background(self, w, h, min_bound, max_bound):
+        """Draws the parts of the widget which do not change with the
+        current framerate (goal line, limits and their labels) into a pixmap
+        """
+        # the pixmap is allocated in device pixels to stay sharp on HiDPI
+        # screens, while it is drawn on in widget coordinates
+        dpr = self.devicePixelRatioF()
+        self._bg_pixmap = QPixmap(int(round(w * dpr)), int(round(h * dpr)))
+        self._bg_pixmap.setDevicePixelRatio(dpr)
+        self._bg_pixmap.fill(Qt.transparent)
+
+        w_min, w_max, h_min, h_max = self._geometry(w, h)
+        delta_bound = max_bound - min_bound
+
+        p = QPainter()
+        p.begin(self._bg_pixmap)
+        p.setFont(self.font())
+
+        if self.g_fps is not None:
+            # Draw the goal line
+            loc_g = (self.g_fps - min_bound) / delta_bound
+            p.setPen(QPen(QColor(*self.goal_color), 3))
+            w_l = int(w_min + loc_g * (w_max - w_min))
+            p.drawLine(w_l, h_min, w_l, h_max)
+
+        # Draw the limits, both in a single call
+        p.setPen(QPen(QColor(*self.limit_color)))
+        p.drawLines(
+            [QLineF(w_min, h_min, w_min, h_max), QLineF(w_max, h_min, w_max, h_max)]
+        )
 
-        min_bound = np.floor(lb * 0.08) * 10
-        max_bound = np.ceil(ub * 0.12) * 10
+        p.drawText(QPoint(w_min, self.text_height), str(min_bound))
+        maxst = str(max_bound)
+        textw = self._text_width(maxst)
+        p.drawText(QPoint(w_max - textw, self.text_height), maxst)
+
+        p.end()
+
+    def _background_key(self, w, h, min_bound, max_bound):
+        """Everything the cached background depends on"""
+        return w, h, self.devicePixelRatioF(), min_bound, max_bound, self.g_fps
+
+    def _geometry(self, w, h):
+        return 0, w - self.pad, self.text_height + self.pad, h - self.pad
+
+    def paintEvent(self, e):
+        bounds = self._bounds()
+        if bounds is None:
+            return
+        min_bound, max_bound = bounds
         delta_bound = max_bound - min_bound
 
         size = self.size()
-        pad = 6
         w = size.width()
         h = size.height()
 
-        p = QPainter()
-        p.begin(self)
-        fm = p.fontMetrics()
+        bg_key = self._background_key(w, h, min_bound, max_bound)
+        if bg_key != self._bg_key:
+            self._render_background(w, h, min_bound, max_bound)
+            self._bg_key = bg_key
 
-        if max_bound == min_bound:
-            max_bound += 1
+        dirty = e.rect()
+        self._last_dynamic_rects = self._dynamic_rects(w, h, min_bound, max_bound)
+        indicator_dirty = any(
+            dirty.intersects(rect) for rect in self._last_dynamic_rects
+        )
 
-        limit_color = (200, 200, 200)
-        goal_color = (80, 80, 80)
+        p = QPainter()
+        p.begin(self)
+        p.setClipRect(dirty)
 
         if self.fps is not None and self.g_fps is not None and self.fps < self.g_fps:
             indicator_color = self.error_indicator_color
@@ -92,17 +294,10 @@ class FramerateWidget(QWidget):
             indicator_color = self.indicator_color
             shadow_color = self.indicator_shadow_color
 
-        w_min = 0
-        w_max = w - pad
+        w_min, w_max, h_min, h_max = self._geometry(w, h)
         delta_w = w_max - w_min
-        text_height = 16
-        h_max = h - pad
-        h_min = text_height + pad
-
-        if self.set_fps and self.fps is not None:
-            loc = (self.fps - min_bound) / delta_bound
-            w_l = int(w_min + loc * delta_w)
 
+        if indicator_dirty:
             w_shadow_min = int(
                 w_min + (self.fps_inertia_min - min_bound) * delta_w / delta_bound
             )
@@ -118,45 +313,56 @@ class FramerateWidget(QWidget):
             w_rect = w_shadow_max - w_shadow_min
             p.drawRect(l_corner, h_min, w_rect, h_max - h_min)
 
+            loc = (self.fps - min_bound) / delta_bound
+            w_l = int(w_min + loc * delta_w)
+
             # Draw the indicator line
             p.setPen(QPen(QColor(*indicator_color)))
 
             p.drawLine(w_l, h_min, w_l, h_max + 5)
 
             val_str = "{:.1f}".format(self.fps)
-            textw = fm.width(val_str)
-
-            p.drawText(QPoint((w_max + w_min - textw) // 2, text_height), val_str)
-
-        if self.g_fps is not None:
-            # Draw the goal line
-            loc_g = (self.g_fps - min_bound) / delta_bound
-            p.setPen(QPen(QColor(*goal_color), 3))
-            w_l = int(w_min + loc_g * delta_w)
-            p.drawLine(w_l, h_min, w_l, h_max)
+            textw = self._text_width(val_str)
 
-        # Draw the limits
-        p.setPen(QPen(QColor(*limit_color)))
-        p.drawLine(w_min, h_min, w_min, h_max)
-        p.drawLine(w_max, h_min, w_max, h_max)
+            p.drawText(QPoint((w_max + w_min - textw) // 2, self.text_height), val_str)
 
-        p.drawText(QPoint(w_min, text_height), str(min_bound))
-        maxst = str(max_bound)
-        textw = fm.width(maxst)
-        p.drawText(QPoint(w_max - textw, text_height), maxst)
+        # The goal line and the limits go over the indicator
+        p.drawPixmap(0, 0, self._bg_pixmap)
 
         p.end()
 
 
 class MultiFrameratesWidget(QWidget):
-    def __init__(self):
+    """Displays a row of framerate indicators, refreshed by an internal
+    timer at a rate independent of the acquisition framerates.
+
+    Parameters
+    ----------
+    update_interval : int
+        interval between refreshes, in ms
+
+    """
+
+    def __init__(self, update_interval=1000 // 30):
         super().__init__()
         self.fr_widgets = []
         self.setLayout(QHBoxLayout())
+        self._timer = QTimer(self)
+        self._timer.setInterval(update_interval)
+        self._timer.timeout.connect(self._tick)
 
-    def update(self):
+    def showEvent(self, e):
+        self._timer.start()
+        super().showEvent(e)
+
+    def hideEvent(self, e):
+        self._timer.stop()
+        super().hideEvent(e)
+
+    def _tick(self):
         for wid in self.fr_widgets:
-            wid.update()
+            if wid.needs_update():
+                wid.update()
 
     def add_framerate(self, framerate_acc):
         lbl_name = QLabel(framerate_acc.name)
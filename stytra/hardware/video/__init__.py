@@ -5,24 +5,65 @@ implement video saving
 
 import numpy as np
 
-from multiprocessing import Queue, Event
+from multiprocessing import Queue, Event, Semaphore
 from queue import Empty, Full
 
 from lightparam import Param
 from lightparam.param_qt import ParametrizedQt
 
 from stytra.hardware.video.cameras.interface import CameraError
-from stytra.utilities import FrameProcess
+from stytra.utilities import FrameProcess, FrameratePacer
 from arrayqueues.shared_arrays import IndexedArrayQueue
-import flammkuchen as fl
 
 from stytra.hardware.video.cameras import camera_class_dict
 
-from stytra.hardware.video.write import VideoWriter
-
 from stytra.hardware.video.ring_buffer import RingBuffer
+from stytra.hardware.video.rotation import rot90_into, compile_rotation
+
 
-import time
+class BoundedIndexedArrayQueue(IndexedArrayQueue):
+    """An IndexedArrayQueue which holds at most max_pending items not yet
+    taken by a consumer. The count is kept in a semaphore, so that the
+    producer can check it without querying the queue size.
+
+    Parameters
+    ----------
+    max_pending : int
+        maximum number of items waiting in the queue, above which
+        put raises queue.Full
+
+    """
+
+    def __init__(self, *args, max_pending=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_pending = max_pending
+        self.free_slots = Semaphore(max_pending)
+
+    def put(self, element, timestamp=None):
+        if not self.free_slots.acquire(block=False):
+            raise Full("More than the maximum number of items pending")
+        try:
+            super().put(element, timestamp)
+        except BaseException:
+            # the item was not inserted, so the slot is given back
+            self.free_slots.release()
+            raise
+
+    def get(self, **kwargs):
+        item = super().get(**kwargs)
+        self.free_slots.release()
+        return item
+
+    def clear(self):
+        # a short timeout lets items still being flushed into the
+        # underlying queue arrive, otherwise their slots would not be freed
+        while True:
+            try:
+                self.queue.get(timeout=0.01)
+                self.free_slots.release()
+            except Empty:
+                break
+        super().clear()
 
 
 class VideoSource(FrameProcess):
@@ -41,8 +82,11 @@ class VideoSource(FrameProcess):
     **Output Queues**
 
     self.frame_queue :
-        TimestampedArrayQueue from the arrayqueues module
-        where the frames read from the camera are sent.
+        BoundedIndexedArrayQueue, based on the arrayqueues module,
+        where the frames read from the camera are sent. The frames are
+        copied into a ring of slots in shared memory, and only the slot
+        index, frame number and timestamp go through the underlying
+        multiprocessing queue, so no pixel data is pickled.
 
 
     **Events**
@@ -63,28 +107,24 @@ class VideoSource(FrameProcess):
 
     """
 
-    def __init__(self, rotation=False, max_mbytes_queue=200, n_consumers=1):
+    def __init__(self, rotation=0, max_mbytes_queue=200, n_consumers=1):
         """ """
         super().__init__(name="camera")
-        self.rotation = rotation
+        # number of counterclockwise quarter turns, between 0 and 3
+        self.rotation = int(rotation) % 4 if rotation else 0
         self.control_queue = Queue()
-        self.frame_queue = IndexedArrayQueue(max_mbytes=max_mbytes_queue)
         self.kill_event = Event()
         self.n_consumers = 1
+        self.frame_queue = BoundedIndexedArrayQueue(
+            max_mbytes=max_mbytes_queue, max_pending=self.n_consumers + 2
+        )
         self.state = None
 
     def put_frame(self, frame, messages):
-        # If the queue is full, arrayqueues should print a warning!
         try:
-            if self.frame_queue.queue.qsize() < self.n_consumers + 2:
-                self.frame_queue.put(frame)
-            else:
-                messages.append("W:Dropped frame")
-        except NotImplementedError:
-            try:
-                self.frame_queue.put(frame)
-            except Full:
-                messages.append("W:Dropped frame")
+            self.frame_queue.put(frame)
+        except Full:
+            messages.append("W:Dropped frame")
         self.update_framerate()
 
 
@@ -136,11 +176,45 @@ class CameraSource(VideoSource):
 
         self.state = None
         self.ring_buffer = None
+        self._rot_buf = None
+
+    def rotate_frame(self, arr):
+        """Rotates the frame into a preallocated contiguous buffer, which is
+        reused as the frame and ring buffer queues copy their inputs.
+        Grayscale frames are rotated by a parallel compiled kernel, the
+        others through numpy.
+        """
+        if self._rot_buf is not None and np.may_share_memory(arr, self._rot_buf):
+            # the kernel can not rotate a frame in place
+            arr = arr.copy()
+        k = self.rotation
+        if k % 2 == 1:
+            rotated_shape = (arr.shape[1], arr.shape[0]) + arr.shape[2:]
+        else:
+            rotated_shape = arr.shape
+        if (
+            self._rot_buf is None
+            or self._rot_buf.shape != rotated_shape
+            or self._rot_buf.dtype != arr.dtype
+        ):
+            self._rot_buf = np.empty(rotated_shape, arr.dtype)
+            # the first frame of a given shape goes through numpy
+            np.copyto(self._rot_buf, np.rot90(arr, k))
+        elif arr.ndim == 2:
+            rot90_into(arr, self._rot_buf, k)
+        else:
+            np.copyto(self._rot_buf, np.rot90(arr, k))
+        return self._rot_buf
 
     def retrieve_params(self, messages):
+        """Sets the parameters received from the control queue, returns
+        whether any were received
+        """
+        received = False
         while True:
             try:
-                param_dict = self.control_queue.get(timeout=0.0001)
+                param_dict = self.control_queue.get_nowait()
+                received = True
                 self.state.params.values = param_dict
                 for param, value in param_dict.items():
                     ms = self.cam.set(param, value)
@@ -150,6 +224,21 @@ class CameraSource(VideoSource):
                         pass
             except Empty:
                 break
+        return received
+
+    def update_ring_buffer(self):
+        """Reallocates the ring buffer if the replay length changed"""
+        res_len = int(round(self.state.framerate * self.state.ring_buffer_length))
+        if res_len > self.max_buffer_length:
+            res_len = self.max_buffer_length
+            self.message_queue.put(
+                "W:Replay buffer too big, make the plot"
+                " time range smaller for full replay"
+                " capabilities"
+            )
+
+        if self.ring_buffer is None or res_len != self.ring_buffer.length:
+            self.ring_buffer = RingBuffer(res_len)
 
     def run(self):
         """
@@ -172,66 +261,83 @@ class CameraSource(VideoSource):
             raise Exception("{} is not a valid camera type!".format(self.camera_type))
         camera_messages = list(self.cam.open_camera())
         [self.message_queue.put(m) for m in camera_messages]
-        prt = None
+        if self.rotation != 0:
+            compile_rotation(self.rotation)
+        pacer = FrameratePacer()
+        params_changed = True
         while not self.kill_event.is_set():
             # Try to get new parameters from the control queue:
             messages = []
             if self.control_queue is not None:
-                self.retrieve_params(messages)
+                if self.retrieve_params(messages):
+                    params_changed = True
             # Grab the new frame, and put it in the queue if valid:
             try:
                 arr = self.cam.read()
             except CameraError:
-                pass
-
-            if self.rotation:
-                arr = np.rot90(arr, self.rotation)
-
-            res_len = int(round(self.state.framerate * self.state.ring_buffer_length))
-            if res_len > self.max_buffer_length:
-                res_len = self.max_buffer_length
-                self.message_queue.put(
-                    "W:Replay buffer too big, make the plot"
-                    " time range smaller for full replay"
-                    " capabilities"
-                )
-
-            if self.ring_buffer is None or res_len != self.ring_buffer.length:
-                self.ring_buffer = RingBuffer(res_len)
-
-            if self.state.paused:
+                # no new frame, the previous one is not sent again
+                arr = None
+
+            if self.rotation != 0 and arr is not None:
+                arr = self.rotate_frame(arr)
+
+            # the buffer length depends only on the parameters, so it is
+            # checked only when new ones arrive
+            if params_changed:
+                self.update_ring_buffer()
+                # parameters are read into local variables, which are
+                # cheaper to access in the loop
+                paused = self.state.paused
+                replay = self.state.replay
+                replay_fps = self.state.replay_fps
+                replay_limits = self.state.replay_limits
+                params_changed = False
+
+            if paused:
                 self.message_queue.put(
                     "I:Ring_buffer_size:" + str(self.ring_buffer.length)
                 )
                 if self.ring_buffer.arr is not None:
-                    self.frame_queue.put(self.ring_buffer.get_most_recent())
+                    try:
+                        self.frame_queue.put(self.ring_buffer.get_most_recent())
+                    except Full:
+                        pass
                 else:
                     self.message_queue.put("E:camera paused before any frames acquired")
-                prt = None
-            elif self.state.replay and self.state.replay_fps > 0:
+                pacer.reset()
+            elif replay and replay_fps > 0:
                 messages.append(
                     "I:Replaying between {} and {} of {}".format(
-                        *self.state.replay_limits, self.ring_buffer.length
+                        *replay_limits, self.ring_buffer.length
                     )
                 )
                 old_fps = self.framerate_rec.current_framerate
                 if old_fps is not None:
                     self.ring_buffer.replay_limits = (
-                        int(round(self.state.replay_limits[0] * old_fps)),
-                        int(round(self.state.replay_limits[1] * old_fps)),
+                        int(round(replay_limits[0] * old_fps)),
+                        int(round(replay_limits[1] * old_fps)),
                     )
+                # at high replay rates, frames are sent in batches so that
+                # the loop does not need to wake up more than ~60 times
+                # per second. A batch cannot be larger than the number of
+                # frames the queue lets wait for the consumers
+                n_batch = min(
+                    max(1, int(replay_fps / 60)), self.frame_queue.max_pending
+                )
                 try:
-                    self.frame_queue.put(self.ring_buffer.get())
+                    for _ in range(n_batch):
+                        self.frame_queue.put(self.ring_buffer.get())
                 except ValueError:
                     pass
-                delta_t = 1 / self.state.replay_fps
-                if prt is not None:
-                    extrat = delta_t - (time.process_time() - prt)
-                    if extrat > 0:
-                        time.sleep(extrat)
-                prt = time.process_time()
+                except Full:
+                    # consumers are behind: the batch stops here and the
+                    # frame which did not fit is sent first in the next one,
+                    # so the replay is slowed down but no frame is lost
+                    self.ring_buffer.rewind()
+                    messages.append("I:Replay throttled, consumers are behind")
+                pacer.wait(replay_fps / n_batch)
             else:
-                prt = None
+                pacer.reset()
                 if arr is not None:
                     try:
                         self.ring_buffer.put(arr)
@@ -276,52 +382,54 @@ class VideoFileSource(VideoSource):
     def update_params(self):
         while True:
             try:
-                param_dict = self.control_queue.get(timeout=0.0001)
+                param_dict = self.control_queue.get_nowait()
                 self.state.params.values = param_dict
             except Empty:
                 break
 
+    def play_frames(self, frames):
+        """Streams the frames of an array-like, read one at a time"""
+        i_frame = self.offset
+        pacer = FrameratePacer()
+        while not self.kill_event.is_set():
+            messages = []
+            # Try to get new parameters from the control queue:
+            message = ""
+            if self.control_queue is not None:
+                self.update_params()
+
+            # we adjust the framerate
+            pacer.wait(self.state.framerate)
+
+            self.put_frame(frames[i_frame, :, :], messages)
+
+            if not self.state.paused:
+                i_frame += 1
+
+            if i_frame == frames.shape[0]:
+                if self.loop:
+                    i_frame = self.offset
+                else:
+                    break
+
+            for m in messages:
+                self.message_queue.put(m)
+
     def run(self):
         if self.state is None:
             self.state = VideoControlParameters()
         if self.source_file.endswith("h5") or self.source_file.endswith("hdf5"):
-            framedata = fl.load(self.source_file)
-
-            if isinstance(framedata, np.ndarray):
-                frames = framedata
-            else:
-                frames = framedata["video"]
-
-            i_frame = self.offset
-            prt = None
-            while not self.kill_event.is_set():
-                messages = []
-                # Try to get new parameters from the control queue:
-                message = ""
-                if self.control_queue is not None:
-                    self.update_params()
-
-                # we adjust the framerate
-                delta_t = 1 / self.state.framerate
-                if prt is not None:
-                    extrat = delta_t - (time.process_time() - prt)
-                    if extrat > 0:
-                        time.sleep(extrat)
-
-                self.put_frame(frames[i_frame, :, :], messages)
-
-                if not self.state.paused:
-                    i_frame += 1
-
-                if i_frame == frames.shape[0]:
-                    if self.loop:
-                        i_frame = self.offset
-                    else:
-                        break
+            import tables
 
-                for m in messages:
-                    self.message_queue.put(m)
-                prt = time.process_time()
+            # frames are read lazily from the file instead of loading
+            # the whole video in memory
+            with tables.open_file(self.source_file, "r") as h5file:
+                if "/video" in h5file:
+                    frames = h5file.get_node("/video")
+                else:
+                    # an array saved directly with flammkuchen
+                    frames = h5file.get_node("/data")
+                self.play_frames(frames)
 
         else:
             import av
@@ -330,14 +438,15 @@ class VideoFileSource(VideoSource):
             container.streams.video[0].thread_type = "AUTO"
             container.streams.video[0].thread_count = 1
 
-            prt = None
+            pacer = FrameratePacer()
             while self.loop:
                 for framedata in container.decode(video=0):
                     messages = []
                     if self.paused:
                         frame = self.old_frame
                     else:
-                        frame = framedata.to_ndarray(format="rgb24")
+                        # decode straight to a single channel
+                        frame = framedata.to_ndarray(format="gray")
 
                     # adjust the frame rate by adding extra time if the processing
                     # is quicker than the specified framerate
@@ -345,15 +454,10 @@ class VideoFileSource(VideoSource):
                     if self.control_queue is not None:
                         self.update_params()
 
-                    delta_t = 1 / self.state.framerate
-                    if prt is not None:
-                        extrat = delta_t - (time.process_time() - prt)
-                        if extrat > 0:
-                            time.sleep(extrat)
+                    pacer.wait(self.state.framerate)
 
-                    self.put_frame(frame[:, :, 0], messages)
+                    self.put_frame(frame, messages)
 
-                    prt = time.process_time()
                     self.old_frame = frame
 
                     for m in messages:
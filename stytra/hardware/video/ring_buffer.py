@@ -36,5 +36,12 @@ class RingBuffer:
         self.read_idx = (self.read_idx + 1) % replay_range
         return out
 
+    def rewind(self):
+        """Steps the replay back by one item, so that the item returned by
+        the last get is returned again
+        """
+        replay_range = self.replay_limits[1] - self.replay_limits[0]
+        self.read_idx = (self.read_idx - 1) % replay_range
+
     def get_most_recent(self):
         return self.arr[(self.insert_idx + 1) % self.length]
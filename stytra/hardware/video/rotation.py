@@ -0,0 +1,37 @@
+import numpy as np
+from numba import jit, prange
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def rot90_into(src, dst, k):
+    """Rotates a 2D image by k times 90 degrees counterclockwise
+    (as np.rot90) and writes the result into dst, which has to be of the
+    rotated shape.
+    """
+    n_rows, n_cols = src.shape
+    if k == 1:
+        for i in prange(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                dst[i, j] = src[j, n_cols - 1 - i]
+    elif k == 2:
+        for i in prange(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                dst[i, j] = src[n_rows - 1 - i, n_cols - 1 - j]
+    elif k == 3:
+        for i in prange(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                dst[i, j] = src[n_rows - 1 - j, i]
+    else:
+        for i in prange(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                dst[i, j] = src[i, j]
+
+
+def compile_rotation(k):
+    """Compiles rot90_into for the usual camera frame types, so that the
+    compilation does not happen during acquisition
+    """
+    for dtype in (np.uint8, np.uint16):
+        src = np.zeros((2, 3), dtype)
+        dst = np.empty((3, 2) if k % 2 == 1 else (2, 3), dtype)
+        rot90_into(src, dst, k)
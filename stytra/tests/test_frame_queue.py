@@ -0,0 +1,69 @@
+from queue import Empty, Full
+import time
+
+import numpy as np
+import pytest
+
+from stytra.hardware.video import BoundedIndexedArrayQueue
+
+
+def test_bounded_queue():
+    q = BoundedIndexedArrayQueue(max_mbytes=1, max_pending=2)
+    frame = np.zeros((10, 10), np.uint8)
+
+    q.put(frame)
+    q.put(frame + 1)
+    with pytest.raises(Full):
+        q.put(frame + 2)
+
+    # getting an item frees a slot
+    _, index, got = q.get(timeout=1)
+    assert index == 0
+    np.testing.assert_array_equal(got, frame)
+    q.put(frame + 3)
+    with pytest.raises(Full):
+        q.put(frame)
+
+    _, index, got = q.get(timeout=1)
+    assert index == 1
+    np.testing.assert_array_equal(got, frame + 1)
+    _, index, got = q.get(timeout=1)
+    assert index == 2
+    np.testing.assert_array_equal(got, frame + 3)
+    with pytest.raises(Empty):
+        q.get(timeout=0.01)
+
+
+def wait_until_visible(q, timeout=10.0):
+    """Waits for the feeder thread of the queue to flush the first item"""
+    t_start = time.monotonic()
+    while q.queue.empty():
+        assert time.monotonic() - t_start < timeout
+        time.sleep(0.001)
+
+
+def test_bounded_queue_clear():
+    q = BoundedIndexedArrayQueue(max_mbytes=1, max_pending=2)
+    frame = np.zeros((10, 10), np.uint8)
+    q.put(frame)
+    q.put(frame)
+    # wait for the items to reach the underlying queue before clearing
+    wait_until_visible(q)
+    q.clear()
+
+    # all slots are free again after clearing
+    q.put(frame)
+    q.put(frame)
+    with pytest.raises(Full):
+        q.put(frame)
+
+
+def test_bounded_queue_failed_put():
+    q = BoundedIndexedArrayQueue(max_mbytes=1, max_pending=1)
+    # a frame larger than the queue memory can not be inserted, as the
+    # arrayqueues view of the shared memory has no room for a single item
+    with pytest.raises(IndexError):
+        q.put(np.zeros((2000, 1000), np.uint8))
+
+    # the slot is given back after the failed put
+    q.put(np.zeros((10, 10), np.uint8))
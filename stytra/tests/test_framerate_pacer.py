@@ -0,0 +1,35 @@
+import time
+from stytra.utilities import FrameratePacer
+
+
+def test_first_wait_is_immediate():
+    pacer = FrameratePacer()
+    t_start = time.monotonic()
+    pacer.wait(2.0)
+    assert time.monotonic() - t_start < 0.05
+
+
+def test_fixed_rate():
+    pacer = FrameratePacer()
+    framerate = 100.0
+    n_waits = 20
+    pacer.wait(framerate)
+    t_start = time.monotonic()
+    for _ in range(n_waits):
+        pacer.wait(framerate)
+    elapsed = time.monotonic() - t_start
+    assert abs(elapsed - n_waits / framerate) < 0.05
+
+
+def test_restart():
+    pacer = FrameratePacer()
+    pacer.wait(2.0)
+    pacer.reset()
+    t_start = time.monotonic()
+    pacer.wait(2.0)
+    assert time.monotonic() - t_start < 0.05
+
+    # a change of framerate restarts the schedule as well
+    t_start = time.monotonic()
+    pacer.wait(4.0)
+    assert time.monotonic() - t_start < 0.05
@@ -0,0 +1,10 @@
+from stytra.gui.framerate_viewer import framerate_limits
+
+
+def test_framerate_limits():
+    assert framerate_limits(None, None, None) is None
+    assert framerate_limits(None, None, 100.0) == (100.0, 100.0)
+    assert framerate_limits(90.0, 110.0, None) == (90.0, 110.0)
+    assert framerate_limits(90.0, 110.0, 100.0) == (90.0, 110.0)
+    assert framerate_limits(90.0, 110.0, 150.0) == (90.0, 150.0)
+    assert framerate_limits(90.0, 110.0, 50.0) == (50.0, 110.0)
@@ -0,0 +1,28 @@
+import numpy as np
+from stytra.hardware.video import CameraSource
+from stytra.hardware.video.rotation import rot90_into
+
+
+def test_rot90_into():
+    for dtype in (np.uint8, np.uint16):
+        src = np.arange(5 * 7, dtype=dtype).reshape(5, 7)
+        for k in range(4):
+            expected = np.rot90(src, k)
+            dst = np.empty(expected.shape, dtype)
+            rot90_into(src, dst, k)
+            np.testing.assert_array_equal(dst, expected)
+
+
+def test_rotate_frame_own_output():
+    """A frame rotated by the camera source, and rotated again, is
+    rotated twice and not corrupted by the reuse of the output buffer
+    """
+    for rotation, shape in [(1, (4, 4)), (2, (3, 4)), (3, (3, 4))]:
+        source = CameraSource("opencv", rotation=rotation)
+        frame = np.arange(np.prod(shape), dtype=np.uint8).reshape(shape)
+        # the second call goes through the compiled kernel
+        source.rotate_frame(frame)
+        rotated = source.rotate_frame(frame)
+        np.testing.assert_array_equal(rotated, np.rot90(frame, rotation))
+        rotated_twice = source.rotate_frame(rotated)
+        np.testing.assert_array_equal(rotated_twice, np.rot90(frame, 2 * rotation))
@@ -71,6 +71,42 @@ class FramerateRecorder:
         self.i_fps = (self.i_fps + 1) % self.n_fps_frames
 
 
+class FrameratePacer:
+    """Keeps a loop running at a given framerate by sleeping until the
+    scheduled time of the next iteration. The schedule is kept on the
+    monotonic wall clock and advanced by a fixed interval, so that the
+    time spent outside of the sleep does not accumulate as drift.
+    """
+
+    def __init__(self):
+        self.next_t = None
+        self.delta_t = None
+
+    def reset(self):
+        """Restarts the schedule at the next call of wait"""
+        self.next_t = None
+
+    def wait(self, framerate):
+        """Sleeps until the next iteration of a loop at the given framerate
+        is due. The first call after a reset, or after a change of
+        framerate, returns immediately.
+        """
+        delta_t = 1 / framerate
+        now = time.monotonic()
+        if self.next_t is None or delta_t != self.delta_t:
+            self.next_t = now
+            self.delta_t = delta_t
+            return
+
+        self.next_t += delta_t
+        if self.next_t > now:
+            time.sleep(self.next_t - now)
+        elif now - self.next_t > delta_t:
+            # if the loop fell more than an interval behind, do not try
+            # to catch up by bursting through iterations
+            self.next_t = now
+
+
 class FrameProcess(Process):
     """A basic class for a process that deals with frames. It provides
     framerate calculation.